@@ -17,29 +17,37 @@
 
 # Helper script for generating word list dictionaries.
 
+from collections import defaultdict
+from functools import lru_cache
+import itertools
 import nltk
 from nltk import FreqDist
 from nltk.corpus import brown, gutenberg, reuters, wordnet
 
 
+@lru_cache(maxsize=None)
 def clean(s):
     return s.lower().replace("_", " ")
 
 
 english_frequencies = None
+english_vocab = None
 
 
 def load_english_frequencies():
     nltk.download(['brown', 'gutenberg', 'reuters'])
 
-    global english_frequencies
-    english_frequencies = FreqDist(w.lower() for w in brown.words())
-    english_frequencies.update(w.lower() for w in gutenberg.words())
-    english_frequencies.update(w.lower() for w in reuters.words())
+    global english_frequencies, english_vocab
+    english_frequencies = FreqDist(w.lower() for w in itertools.chain(brown.words(), gutenberg.words(), reuters.words()))
+    n = english_frequencies.N()
+    english_frequencies.N = lambda: n
+
+    # only the zero/non-zero test is needed for filtering
+    english_vocab = frozenset(english_frequencies)
 
 
 def generate_hypernyms():
-    dictionary = {}
+    dictionary = defaultdict(list)
     for pos in ["n", "a"]:
         for synset in wordnet.all_synsets(pos):
             hypernyms = synset.hypernyms()
@@ -51,13 +59,13 @@ def generate_hypernyms():
             for hypernym in hypernyms:
                 for lemma in hypernym.lemmas():
                     word = clean(lemma.name())
-                    if english_frequencies[word] == 0:
+                    if word not in english_vocab:
                         continue
                     word_list.append(word)
 
             if word_list:
                 key = clean(synset.lemmas()[0].name())
-                dictionary[key] = dictionary.get(key, []) + word_list
+                dictionary[key].extend(word_list)
 
     with open("hypernym-dictionary.tsv", "w") as f:
         for key in sorted(dictionary.keys()):
@@ -65,7 +73,7 @@ def generate_hypernyms():
 
 
 def generate_synonyms():
-    dictionary = {}
+    dictionary = defaultdict(list)
     for pos in ["n", "a"]:
         for synset in wordnet.all_synsets(pos):
             hypernyms = synset.hypernyms()
@@ -81,13 +89,13 @@ def generate_synonyms():
 
                     for lemma in hyponym.lemmas():
                         word = clean(lemma.name())
-                        if english_frequencies[word] == 0:
+                        if word not in english_vocab:
                             continue
                         word_list.append(word)
 
             if word_list:
                 key = clean(synset.lemmas()[0].name())
-                dictionary[key] = dictionary.get(key, []) + word_list
+                dictionary[key].extend(word_list)
 
     with open("synonym-dictionary.tsv", "w") as f:
         for key in sorted(dictionary.keys()):
@@ -16,110 +16,258 @@
 
 # Plot JSD obfuscation epsilon_0 base line of an authorship corpus
 
-from glob import glob
 import nltk
 from nltk import FreqDist
-from math import fsum, log2, sqrt
+from functools import lru_cache
+from math import log2, sqrt
+import multiprocessing
 import numpy as np
 import os
 import matplotlib.pyplot as plt
+from numba import njit
+from numba.core import types
+from numba.typed import Dict
 import re
 import sys
 
 
-def normalize(string: str) -> str:
+# patterns operate on UTF-8 encoded bytes, multi-byte characters are matched by their encoded sequences
+_RE_NUM = re.compile(rb"[0-9]")
+_RE_QUOTES = re.compile(rb"(?:''|``|\"|\xe2\x80[\x98\x99\x9c\x9d\x9e]|\xc2[\xab\xbb])")           # "„“”‘’«»
+_RE_DASH = re.compile(rb"(?:(?:\xe2\x80[\x92-\x95])+|-{2,})")                                      # ‒–—―
+_RE_WS = re.compile(rb"(?:[\s\x1c-\x1f]|\xc2[\x85\xa0]|\xe1\x9a\x80|\xe2\x80[\x80-\x8a\xa8\xa9\xaf]|"
+                    rb"\xe2\x81\x9f|\xe3\x80\x80)+")                                                # Unicode whitespace
+
+
+def normalize(string: bytes) -> bytes:
+    """
+    Cached version of :func:`_normalize` for library use. Only the last few strings shorter than 1 MB
+    are cached. main() normalizes each file exactly once and does not benefit from it.
+    """
+    if len(string) < 1_000_000:
+        return _normalize_cached(string)
+
+    return _normalize(string)
+
+
+@lru_cache(maxsize=8)
+def _normalize_cached(string: bytes) -> bytes:
+    return _normalize(string)
+
+
+def _normalize(string: bytes) -> bytes:
     """
-    Normalize a text string.
+    Normalize a UTF-8 encoded text string.
 
     :param string: input string
     :return: normalized string
     """
-    string = string.replace("\xef\xbb\xbf", "")                      # remove UTF-8 BOM
-    string = string.replace("\ufeff", "")                            # remove UTF-16 BOM
-    # string = unicodedata.normalize("NFKD", string)                   # convert to NFKD normal form
-    string = re.compile(r"[0-9]").sub("0", string)                   # map all numbers to "0"
-    string = re.compile(r"(?:''|``|[\"„“”‘’«»])").sub("'", string)   # normalize quotes
-    string = re.compile(r"(?:[‒–—―]+|-{2,})").sub("--", string)      # normalize dashes
-    string = re.compile(r"\s+").sub(" ", string)                     # collapse whitespace characters
+    string = string.replace("\xef\xbb\xbf".encode("utf-8"), b"")      # remove UTF-8 BOM
+    string = string.replace("\ufeff".encode("utf-8"), b"")            # remove UTF-16 BOM
+    string = _RE_NUM.sub(b"0", string)                               # map all numbers to "0"
+    string = _RE_QUOTES.sub(b"'", string)                            # normalize quotes
+    string = _RE_DASH.sub(b"--", string)                             # normalize dashes
+    string = _RE_WS.sub(b" ", string)                                # collapse whitespace characters
 
     return string.strip()
 
 
-def kld_i(p, q):
+def _aligned_probs(t1_freq, t2_freq, t1_n, t2_n):
     """
-    Calculate a single KLD summand.
+    Build aligned probability arrays over the union of both n-gram sets.
 
-    :param p: probability 1
-    :param q: probability 2
-    :return: KLD summand
+    :param t1_freq: text 1 n-gram counts
+    :param t2_freq: text 2 n-gram counts
+    :param t1_n: total number of n-grams in text 1
+    :param t2_n: total number of n-grams in text 2
+    :return: tuple of text 1 and text 2 probability arrays
     """
-    if p == 0:
-        return 0.0
+    mixed_freq = t1_freq.keys() | t2_freq.keys()
+    p_get = t1_freq.get
+    q_get = t2_freq.get
 
-    return p * log2(p / q)
+    p = np.fromiter((p_get(k, 0) for k in mixed_freq), dtype=np.float64, count=len(mixed_freq))
+    q = np.fromiter((q_get(k, 0) for k in mixed_freq), dtype=np.float64, count=len(mixed_freq))
+    p /= t1_n
+    q /= t2_n
 
+    return p, q
 
-def js_dist(t1_freq, t2_freq):
+
+@njit(cache=True)
+def _js_dist_typed(t1_freq, t2_freq, t1_n, t2_n):
     """
-    Calculate Jensen-Shannon distance.
+    Calculate Jensen-Shannon distance directly on two typed count dicts.
 
-    :param t1_freq: text 1 distribution
-    :param t2_freq: text 2 distribution
+    :param t1_freq: text 1 n-gram counts
+    :param t2_freq: text 2 n-gram counts
+    :param t1_n: total number of n-grams in text 1
+    :param t2_n: total number of n-grams in text 2
     :return:
     """
-    mixed_freq = set(t1_freq) | set(t2_freq)
+    kld = 0.0
+    for k, c in t1_freq.items():
+        p = c / t1_n
+        q = t2_freq.get(k, 0) / t2_n
+        m = 0.5 * (p + q)
+        kld += p * log2(p / m)
+        if q > 0:
+            kld += q * log2(q / m)
 
-    jsd_vals_p = []
-    jsd_vals_q = []
+    # n-grams only in text 2 have m = q / 2, so their summand is q
+    for k, c in t2_freq.items():
+        if k not in t1_freq:
+            kld += c / t2_n
 
-    for ngram in mixed_freq:
-        p_norm = t1_freq[ngram] / t1_freq.N()
-        q_norm = t2_freq[ngram] / t2_freq.N()
+    return sqrt(kld)
 
-        m = 0.5 * (p_norm + q_norm)
-        jsd_vals_p.append(kld_i(p_norm, m))
-        jsd_vals_q.append(kld_i(q_norm, m))
 
-    return sqrt(fsum(jsd_vals_p) + fsum(jsd_vals_q))
+@njit(cache=True)
+def _hellinger_dist_typed(t1_freq, t2_freq, t1_n, t2_n):
+    """
+    Calculate Hellinger distance directly on two typed count dicts.
 
+    :param t1_freq: text 1 n-gram counts
+    :param t2_freq: text 2 n-gram counts
+    :param t1_n: total number of n-grams in text 1
+    :param t2_n: total number of n-grams in text 2
+    :return:
+    """
+    dist = 0.0
+    for k, c in t1_freq.items():
+        dist += (sqrt(c / t1_n) - sqrt(t2_freq.get(k, 0) / t2_n)) ** 2
 
-def hellinger_dist(t1_freq, t2_freq):
+    # n-grams only in text 2 contribute q
+    for k, c in t2_freq.items():
+        if k not in t1_freq:
+            dist += c / t2_n
+
+    return sqrt(dist)
+
+
+def js_dist(t1_freq, t2_freq, t1_n, t2_n):
+    """
+    Calculate Jensen-Shannon distance.
+
+    :param t1_freq: text 1 n-gram counts
+    :param t2_freq: text 2 n-gram counts
+    :param t1_n: total number of n-grams in text 1
+    :param t2_n: total number of n-grams in text 2
+    :return:
+    """
+    if isinstance(t1_freq, Dict) and isinstance(t2_freq, Dict):
+        return _js_dist_typed(t1_freq, t2_freq, t1_n, t2_n)
+
+    p, q = _aligned_probs(t1_freq, t2_freq, t1_n, t2_n)
+    m = 0.5 * (p + q)
+
+    # KLD summands are 0 where p (or q) is 0, so only sum over non-zero entries
+    p_nz = p > 0
+    q_nz = q > 0
+    kld_p = np.dot(p[p_nz], np.log2(p[p_nz] / m[p_nz]))
+    kld_q = np.dot(q[q_nz], np.log2(q[q_nz] / m[q_nz]))
+
+    return sqrt(kld_p + kld_q)
+
+
+def hellinger_dist(t1_freq, t2_freq, t1_n, t2_n):
     """
     Calculate Hellinger distance.
 
-    :param t1_freq: text 1 distribution
-    :param t2_freq: text 2 distribution
+    :param t1_freq: text 1 n-gram counts
+    :param t2_freq: text 2 n-gram counts
+    :param t1_n: total number of n-grams in text 1
+    :param t2_n: total number of n-grams in text 2
     :return:
     """
-    mixed_freq = set(t1_freq) | set(t2_freq)
-    dist_vals = []
+    if isinstance(t1_freq, Dict) and isinstance(t2_freq, Dict):
+        return _hellinger_dist_typed(t1_freq, t2_freq, t1_n, t2_n)
 
-    for ngram in mixed_freq:
-        p_norm = t1_freq[ngram] / t1_freq.N()
-        q_norm = t2_freq[ngram] / t2_freq.N()
-        dist_vals.append(pow(sqrt(p_norm) - sqrt(q_norm), 2))
+    p, q = _aligned_probs(t1_freq, t2_freq, t1_n, t2_n)
 
-    # return 1.0 / sqrt(2) * sqrt(fsum(dist_vals))
-    return sqrt(fsum(dist_vals))
+    # return 1.0 / sqrt(2) * float(np.linalg.norm(np.sqrt(p) - np.sqrt(q)))
+    return float(np.linalg.norm(np.sqrt(p) - np.sqrt(q)))
+
+
+def _freeze_N(freq):
+    """
+    Cache the sample count of a FreqDist, which is otherwise re-summed on every N() call.
+    The FreqDist must not be updated afterwards.
+
+    :param freq: FreqDist
+    :return: the same FreqDist
+    """
+    n = freq.N()
+    freq.N = lambda: n
+    return freq
 
 
 def byte_ngrams(t1, t2, order=3):
     """
     Generate byte n-gram distributions.
+    N-grams are packed into a single int key.
 
-    :param t1: text1
-    :param t2: text2
+    :param t1: UTF-8 encoded text1
+    :param t2: UTF-8 encoded text2
     :param order: n-gram order
-    :return: tuple containing FreqDists
+    :return: tuple containing a (counts, total number of n-grams) pair for each text
     """
 
-    t1 = t1.encode(encoding="utf-8")
-    t2 = t2.encode(encoding="utf-8")
+    t1_n = max(len(t1) - order + 1, 0)
+    t2_n = max(len(t2) - order + 1, 0)
 
-    t1_freq = FreqDist(tuple(t1[i:i + order]) for i in range(len(t1) - order + 1))
-    t2_freq = FreqDist(tuple(t2[i:i + order]) for i in range(len(t2) - order + 1))
+    if order == 3:
+        return ((count_byte_trigrams(np.frombuffer(t1, dtype=np.uint8)), t1_n),
+                (count_byte_trigrams(np.frombuffer(t2, dtype=np.uint8)), t2_n))
 
-    return t1_freq, t2_freq
+    # same keys as the trigram kernel for order 3
+    t1_freq = FreqDist(int.from_bytes(t1[i:i + order], "big") for i in range(t1_n))
+    t2_freq = FreqDist(int.from_bytes(t2[i:i + order], "big") for i in range(t2_n))
+
+    return (t1_freq, t1_n), (t2_freq, t2_n)
+
+
+def empty_byte_trigrams():
+    """
+    Create an empty byte trigram count dict.
+
+    :return: typed dict mapping packed uint32 trigrams to counts
+    """
+    return Dict.empty(key_type=types.uint32, value_type=types.int64)
+
+
+@njit(cache=True)
+def update_byte_trigrams(counts, buf, start, end):
+    """
+    Incrementally update byte trigram counts of a growing buffer prefix.
+    Trigrams are packed into a single uint32 key.
+
+    :param counts: counts of all trigrams in buf[:start], will be updated in place
+    :param buf: encoded text as uint8 array
+    :param start: previous prefix length
+    :param end: new prefix length
+    :return: number of added trigrams
+    """
+    first = max(start - 2, 0)
+    last = max(end - 2, 0)
+    for i in range(first, last):
+        k = np.uint32((np.uint32(buf[i]) << 16) | (np.uint32(buf[i + 1]) << 8) | np.uint32(buf[i + 2]))
+        counts[k] = counts.get(k, 0) + 1
+
+    return max(last - first, 0)
+
+
+@njit(cache=True)
+def count_byte_trigrams(buf):
+    """
+    Count byte trigrams.
+
+    :param buf: encoded text as uint8 array
+    :return: typed dict mapping packed uint32 trigrams to counts
+    """
+    counts = Dict.empty(key_type=types.uint32, value_type=types.int64)
+    update_byte_trigrams(counts, buf, 0, buf.size)
+    return counts
 
 
 def pos_ngrams(t1, t2, order=3):
@@ -135,37 +283,74 @@ def pos_ngrams(t1, t2, order=3):
     t1_freq = FreqDist()
     t2_freq = FreqDist()
 
-    t1 = nltk.sent_tokenize(t1)
-    for s in t1:
-        pos_tags = nltk.pos_tag(nltk.word_tokenize(s))
-        t1_freq.update(tuple(map(lambda x: x[1], pos_tags[i:i + order])) for i in range(len(pos_tags) - order + 1))
+    t1 = nltk.pos_tag_sents([nltk.word_tokenize(s) for s in nltk.sent_tokenize(t1)])
+    for pos_tags in t1:
+        t1_freq.update(tuple(tag for _, tag in pos_tags[i:i + order]) for i in range(len(pos_tags) - order + 1))
 
-    t2 = nltk.sent_tokenize(t2)
-    for s in t2:
-        pos_tags = nltk.pos_tag(nltk.word_tokenize(s))
-        t2_freq.update(tuple(map(lambda x: x[1], pos_tags[i:i + order])) for i in range(len(pos_tags) - order + 1))
+    t2 = nltk.pos_tag_sents([nltk.word_tokenize(s) for s in nltk.sent_tokenize(t2)])
+    for pos_tags in t2:
+        t2_freq.update(tuple(tag for _, tag in pos_tags[i:i + order]) for i in range(len(pos_tags) - order + 1))
 
-    return t1_freq, t2_freq
+    return _freeze_N(t1_freq), _freeze_N(t2_freq)
 
 
-def remove_outliers_iqr(y, min, max):
+def mask_outliers_iqr(y, min, max):
     """
-    Remove outliers using the interquartile range (IQR) method by John Tukey.
+    Mask outliers using the interquartile range (IQR) method by John Tukey.
+    Quartiles are calculated along the last axis, NaN values are ignored.
 
     :param y: y values
     :param min: lower quartile
     :param max: upper quartile
-    :return: non-outliers
+    :return: y values with outliers replaced by NaN
     """
-    if type(y) is not np.ndarray:
-        y = np.array(y)
-
-    q1, q2 = np.percentile(y, [min, max])
+    q1, q2 = np.nanpercentile(y, [min, max], axis=-1, keepdims=True)
     iqr = q2 - q1
     lower_bound = q1 - (iqr * 1.5)
     upper_bound = q2 + (iqr * 1.5)
 
-    return y[(y > lower_bound) & (y < upper_bound)]
+    return np.where((y > lower_bound) & (y < upper_bound), y, np.nan)
+
+
+def process_case(args):
+    """
+    Calculate JS distances between growing prefixes of the known and unknown texts of a case.
+
+    :param args: tuple of case name, truth label, known file paths, unknown file path and minimum prefix length
+    :return: tuple of case name, prefix lengths, distances, truth label and maximum prefix length
+    """
+    case, label_type, known_files, unknown_file, min_x = args
+    print("Case: {}".format(case))
+
+    known_texts = []
+    for fname in known_files:
+        with open(fname, "rb") as f:
+            known_texts.append(normalize(f.read()))
+    known_text = b"".join(known_texts)
+
+    with open(unknown_file, "rb") as f:
+        unknown_text = normalize(f.read())
+
+    max_x_tmp = min(len(known_text), len(unknown_text))
+    x = tuple(range(min_x, max_x_tmp + 1, 100))
+    y = []
+
+    # prefixes only ever grow, so count only the n-grams added by each step
+    known_bytes = np.frombuffer(known_text, dtype=np.uint8)
+    unknown_bytes = np.frombuffer(unknown_text, dtype=np.uint8)
+    n1, n2 = empty_byte_trigrams(), empty_byte_trigrams()
+    n1_total = n2_total = 0
+    prev_xi = 0
+    for xi in x:
+        n1_total += update_byte_trigrams(n1, known_bytes, prev_xi, xi)
+        n2_total += update_byte_trigrams(n2, unknown_bytes, prev_xi, xi)
+        prev_xi = xi
+
+        d = js_dist(n1, n2, n1_total, n2_total)
+        # d = hellinger_dist(n1, n2, n1_total, n2_total)
+        y.append(d)
+
+    return case, x, y, label_type, max_x_tmp
 
 
 def main():
@@ -184,93 +369,74 @@ def main():
     fig = plt.figure()
     ax = fig.add_subplot(111)
     ax.set_ylim((0.4, 1.5))
-    ax.set_xlabel("Text length (characters)")
+    ax.set_xlabel("Text length (bytes)")
     ax.set_ylabel("JS distance")
 
     labels_set = {"Y": False, "N": False}
     min_x = 100
     max_x = min_x
 
-    # x and y values of different-authors curves
-    diff_xs = []
-    diff_ys = []
-
-    for case in list(cases.keys()):
-        print("Case: {}".format(case))
-
-        known_text = ""
-        for fname in glob(os.path.join(corpus, case, "known*.txt")):
-            known_text += normalize(open(fname, encoding="utf-8").read())
-
-        unknown_text = normalize(open(os.path.join(corpus, case, "unknown.txt"), encoding="utf-8").read())
-
-        max_x_tmp = min(len(known_text), len(unknown_text))
+    case_files = {}
+    for case in cases:
+        case_dir = os.path.join(corpus, case)
+        known_files = sorted(e.path for e in os.scandir(case_dir)
+                             if e.name.startswith("known") and e.name.endswith(".txt"))
+        case_files[case] = known_files, os.path.join(case_dir, "unknown.txt")
+
+    with multiprocessing.Pool() as pool:
+        results = list(pool.imap_unordered(process_case, [(c, cases[c], *case_files[c], min_x) for c in cases]))
+
+    # x and y values of different-authors curves, one column per case padded with NaN
+    diff_results = [y for _, _, y, label_type, _ in results if label_type == "N"]
+    diff_xs = np.arange(min_x, min_x + 100 * max(map(len, diff_results), default=0), 100)
+    diff_ys = np.full((len(diff_xs), len(diff_results)), np.nan)
+    for i, y in enumerate(diff_results):
+        diff_ys[:len(y), i] = y
+
+    # plot sequentially, matplotlib is not thread-safe
+    for case, x, y, label_type, max_x_tmp in results:
         max_x = max(max_x, max_x_tmp)
-        x = tuple(range(min_x, max_x_tmp + 1, 100))
-        y = []
-        for xi in x:
-            known_xi = known_text[:xi]
-            unknown_xi = unknown_text[:xi]
-            n1, n2 = byte_ngrams(known_xi, unknown_xi)
-            d = js_dist(n1, n2)
-            # d = hellinger_dist(n1, n2)
-            y.append(d)
-
-            if cases[case] == "N":
-                if len(y) > len(diff_ys):
-                    diff_xs.append(xi)
-                    diff_ys.append([d])
-                else:
-                    diff_ys[len(y) - 1].append(d)
 
         # only show one label for each curve type
-        color = "#ffbf00" if cases[case] == "Y" else "#7a16ff"
+        color = "#ffbf00" if label_type == "Y" else "#7a16ff"
         label = ""
-        if not labels_set[cases[case]]:
-            label = "same author" if cases[case] == "Y" else "different authors"
-            labels_set[cases[case]] = True
+        if not labels_set[label_type]:
+            label = "same author" if label_type == "Y" else "different authors"
+            labels_set[label_type] = True
 
         plt.semilogx(x, y, color=color, basex=2, label=label, linewidth=0.5, alpha=0.36)
 
     # calculate epsilon thresholds
-    eps_x = []
-    eps0_y = []
-    eps05_y = []
-    eps07_y = []
-    eps099_y = []
-    for x, y in zip(diff_xs, diff_ys):
-        if x < 2048:
-            continue
-
-        if len(y) > 4:
-            y = remove_outliers_iqr(y, 30, 70)
-
-        if len(y) < 2:
-            continue
-
-        eps_x.append(x)
-        eps0_y.append(np.percentile(y, 0))
-        eps05_y.append(np.percentile(y, 50))
-        eps07_y.append(np.percentile(y, 70))
-        eps099_y.append(np.percentile(y, 99))
+    eps_rows = diff_xs >= 2048
+    eps_x = diff_xs[eps_rows]
+    eps_y = diff_ys[eps_rows]
+
+    eps_y_count = np.count_nonzero(~np.isnan(eps_y), axis=1)
+    eps_y = np.where((eps_y_count > 4)[:, np.newaxis], mask_outliers_iqr(eps_y, 30, 70), eps_y)
+
+    eps_rows = np.count_nonzero(~np.isnan(eps_y), axis=1) >= 2
+    eps_x = eps_x[eps_rows]
+    eps0_y, eps05_y, eps07_y, eps099_y = np.nanpercentile(eps_y[eps_rows], [0, 50, 70, 99], axis=1)
 
     # fit epsilon lines
-    e0_coefs = np.polyfit([log2(x) for x in eps_x], eps0_y, 1)
-    e05_coefs = np.polyfit([log2(x) for x in eps_x], eps05_y, 1)
-    e07_coefs = np.polyfit([log2(x) for x in eps_x], eps07_y, 1)
-    e099_coefs = np.polyfit([log2(x) for x in eps_x], eps099_y, 1)
-    line_x = tuple(range(min_x, max_x + 1, (max_x - min_x) // 2))
+    eps_lx = np.log2(eps_x)
+    e0_coefs = np.polyfit(eps_lx, eps0_y, 1)
+    e05_coefs = np.polyfit(eps_lx, eps05_y, 1)
+    e07_coefs = np.polyfit(eps_lx, eps07_y, 1)
+    e099_coefs = np.polyfit(eps_lx, eps099_y, 1)
+    line_lx = np.linspace(log2(min_x), log2(max_x), 64)
+    line_x = np.exp2(line_lx)
 
     print("\nε_{{0}} coefs: [{:.05}, {:.05}]".format(float(e0_coefs[0]), float(e0_coefs[1])))
-    plt.semilogx(line_x, [e0_coefs[0] * log2(x) + e0_coefs[1] for x in line_x],
+    plt.semilogx(line_x, e0_coefs[0] * line_lx + e0_coefs[1],
                  color="#e54709", basex=2, label=r"$\epsilon_0$", linewidth=1.5)
 
     print("\nε_{{0.5}} coefs: [{:.05}, {:.05}]".format(float(e05_coefs[0]), float(e05_coefs[1])))
-    plt.semilogx(line_x, [e05_coefs[0] * log2(x) + e05_coefs[1] for x in line_x],
+    plt.semilogx(line_x, e05_coefs[0] * line_lx + e05_coefs[1],
                  color="#3f00af", basex=2, label=r"$\epsilon_{0.5}$", linewidth=1.5, linestyle="dashed")
 
     print("\nε_{{0.7}} coefs: [{:.05}, {:.05}]".format(float(e07_coefs[0]), float(e07_coefs[1])))
-    plt.semilogx(line_x, [e07_coefs[0] * log2(x) + e07_coefs[1] for x in line_x],
+    plt.semilogx(line_x, e07_coefs[0] * line_lx + e07_coefs[1],
                  color="#3f00af", basex=2, label=r"$\epsilon_{0.7}$", linewidth=1.5, linestyle="dashed")
 
     print("\nε_{{0.99}} coefs: [{:.05}, {:.05}]".format(float(e099_coefs[0]), float(e099_coefs[1])))